@@ -17,6 +17,10 @@ class RequestHandler(tornado.web.RequestHandler):
 
     DESC = "Gets realtime messages through gmail pub/sub webhooks"
 
+    def initialize(self, gmail):
+        # one GmailHistory for the process, its target sinks own the spool dirs
+        self.gmail = gmail
+
     def post(self):
         """
         ref: https://developers.google.com/gmail/api/guides/push#receiving_notifications
@@ -29,15 +33,17 @@ class RequestHandler(tornado.web.RequestHandler):
             return
 
         try:
-            gmail = GmailCommand().get_gmail_obj()
-            gmail.get_new_msg()
+            self.gmail.get_new_msg()
         except IOError as err:  # TODO: Diskdict error
-            log.exception(err)
+            self.gmail.log.exception(err)
 
 
 class GmailCommand(BaseScript):
     DESC = "A tool to get the data from gmail and store it in database"
 
+    # target args which say where the msgs go, the others only tune the delivery
+    IDENTITY_ARGS = ("db_name", "collection_name", "table_name", "topic", "file_path")
+
     def _parse_msg_target_arg(self, t):
         """
         >>> from command import GmailCommand
@@ -52,21 +58,50 @@ class GmailCommand(BaseScript):
 
         return path, args
 
+    def _target_name(self, path, args):
+        """
+        Names a target by its class and where it stores msgs, so its spool dir is kept
+        when tuning args or credentials change. A `name` arg is used as it is.
+
+        >>> from command import GmailCommand
+        >>> obj = GmailCommand()
+        >>> obj._target_name('gmaildump.messagestore.MongoStore', {'db_name': 'gmail', 'collection_name': 'dump', 'w': '2', 'uri': 'mongodb://u:p@host'})
+        'gmaildump.messagestore.MongoStore:collection_name=dump:db_name=gmail'
+        >>> obj._target_name('gmaildump.messagestore.MongoStore', {'name': 'archive', 'db_name': 'gmail'})
+        'archive'
+
+        """
+        if "name" in args:
+            return args["name"]
+
+        ids = sorted((k, v) for k, v in args.items() if k in self.IDENTITY_ARGS)
+        return ":".join([path] + ["{}={}".format(k, v) for k, v in ids])
+
     def msg_store(self):
-        targets = []
+        # keyed by the target name, it names the target's spool dir
+        targets = {}
 
-        for t in self.args.target:
+        for t in self.args.target or []:
             imp_path, args = self._parse_msg_target_arg(t)
+            name = self._target_name(imp_path, args)
+            args.pop("name", None)
+            if name in targets:
+                raise ValueError(
+                    "two targets named {}, tell them apart with name=".format(name)
+                )
+
             target_class = util.load_object(imp_path)
             target_obj = target_class(**args)
-            targets.append(target_obj)
+            targets[name] = target_obj
 
         return targets
 
-    def listen_realtime(self):
+    def listen_realtime(self, gmail):
         self.log.info("Running tornodo on the machine")
 
-        app = tornado.web.Application(handlers=[(r"/", RequestHandler)])
+        app = tornado.web.Application(
+            handlers=[(r"/", RequestHandler, dict(gmail=gmail))]
+        )
         http_server = tornado.httpserver.HTTPServer(app)
         http_server.listen(self.args.tornodo - port)
         tornado.ioloop.IOLoop.instance().start()
@@ -80,6 +115,8 @@ class GmailCommand(BaseScript):
             file_path=self.args.file - path,
             status_path=self.args.status - path,
             targets=targets,
+            spool_path=self.args.spool_path,
+            queue_size=self.args.target_queue_size,
             log=self.log,
         )
         gmail.authorize()  # authorizing gmail service in order to make gmail api calls
@@ -88,17 +125,21 @@ class GmailCommand(BaseScript):
     def run(self):
         gmail = self.get_gmail_obj()
 
-        # start getting the gmail msgs from users mailbox
-        gmail.start()
+        try:
+            # start getting the gmail msgs from users mailbox
+            gmail.start()
 
-        # call gmail api watch request every day
-        th = threading.Thread(target=gmail.renew_mailbox_watch)
-        th.daemon = True
-        th.start()
-        self.thread_watch_gmail = th
+            # call gmail api watch request every day
+            th = threading.Thread(target=gmail.renew_mailbox_watch)
+            th.daemon = True
+            th.start()
+            self.thread_watch_gmail = th
 
-        # listen for real time msgs on tornodo specified port
-        self.listen_realtime()
+            # listen for real time msgs on tornodo specified port
+            self.listen_realtime(gmail)
+        finally:
+            # msgs still queued for the targets are spooled to disk
+            gmail.close()
 
     def define_args(self, parser):
         # gmail api arguments
@@ -150,10 +191,28 @@ class GmailCommand(BaseScript):
             "-target",
             "--target",
             nargs="+",
-            help='format for Mongo: store=<MongoStore-classpath>:db_name=<database-name>:collection_name=<collection-name> \
+            help='format for Mongo: store=<MongoStore-classpath>:db_name=<database-name>:collection_name=<collection-name>[:uri=<mongodb-uri>:max_pool_size=<n>:w=<write-concern>:journal=<true|false>:batch_size=<n>:compress=<true|false>] \
            format for SQLite: store=<SQLiteStore-classpath>:host=<hostname>:port=<port-number>:db_name=<db-name>:table_name=<table-name>" \
            format for NSQ: store=<NsqStore-classpath>:host=<hostname>:port=<port-number>:topic=<topic-name> \
-           format for file: store=<FileStore-classpath>:file_path=<file-path>',
+           format for file: store=<FileStore-classpath>:file_path=<file-path> \
+           any target takes name=<name> to name its spool dir, by default it is named after the class and where the msgs are stored',
+        )
+
+        # target delivery arguments
+        parser.add_argument(
+            "-spool_path",
+            "--spool-path",
+            nargs="?",
+            help="directory where msgs for a slow or failed target \
+                            are spooled until it recovers. Default path: <status-path>/spool",
+        )
+        parser.add_argument(
+            "-queue_size",
+            "--target-queue-size",
+            type=int,
+            default=1000,
+            help="number of msgs kept in memory per target before \
+                            spooling to disk. default: 1000",
         )
 
         # tornodo arguments
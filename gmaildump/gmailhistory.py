@@ -1,15 +1,19 @@
+import os
 import time
 import base64
-from multiprocessing.pool import ThreadPool
+import hashlib
 from copy import deepcopy
 from datetime import datetime, timedelta
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 from httplib2 import Http
 from oauth2client import file, client, tools
 
-from deeputil import Dummy, AttrDict
+from deeputil import Dummy
 from diskdict import DiskDict
 
+from sink import TargetSink
+
 DUMMY_LOG = Dummy()
 
 
@@ -37,6 +41,8 @@ class GmailHistory(object):
         file_path=None,
         status_path="/tmp/",
         targets=None,
+        spool_path=None,
+        queue_size=1000,
         log=DUMMY_LOG,
     ):
 
@@ -44,11 +50,57 @@ class GmailHistory(object):
         self.cred_path = cred_path
         self.query = query
         self.gmail = None
+        self.creds = None
         self.topic = topic_name
         self.file_path = file_path
         self.dd = DiskDict(status_path + "disk.dict")
-        self.targets = targets
-        self._pool = ThreadPool()
+
+        # targets given as {name: target} get a spool dir named after the name,
+        # so it stays with the same target across runs; a list falls back to positions
+        if not isinstance(targets, dict):
+            targets = dict((str(i), t) for i, t in enumerate(targets or []))
+
+        # a queue and worker per target, so a slow one can't hold back the others
+        spool_path = spool_path or os.path.join(status_path, "spool")
+        self.sinks = []
+        for name, t in sorted(targets.items()):
+            digest = hashlib.md5(name.encode("utf8")).hexdigest()[:12]
+            path = os.path.join(spool_path, "{}-{}".format(type(t).__name__, digest))
+            sink = TargetSink(t, path, maxsize=int(queue_size), log=log)
+            sink.start()
+            self.sinks.append(sink)
+
+        self.warn_orphan_spools(spool_path)
+
+    def warn_orphan_spools(self, spool_path):
+        """
+        This fun helps to point out spooled msgs which no configured target will deliver,
+        left behind by a target that was removed or renamed.
+
+        >>> import os, tempfile
+        >>> from mock import Mock
+        >>> spool_path = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(spool_path, 'Store-0123456789ab'))
+        >>> open(os.path.join(spool_path, 'Store-0123456789ab', '00000000000000000000.seg'), 'w').close()
+        >>> obj = GmailHistory(status_path=tempfile.mkdtemp() + '/', log=Mock())
+        >>> obj.warn_orphan_spools(spool_path)
+        >>> obj.log.warning.call_args[1]['spool']
+        'Store-0123456789ab'
+
+        """
+        if not os.path.isdir(spool_path):
+            return
+
+        used = set(sink.name for sink in self.sinks)
+        for name in sorted(os.listdir(spool_path)):
+            path = os.path.join(spool_path, name)
+            if name in used or not os.path.isdir(path):
+                continue
+
+            if any(f.endswith(".seg") for f in os.listdir(path)):
+                self.log.warning(
+                    "spooled msgs with no matching target", spool=name, path=path
+                )
 
     def authorize(self):
         """
@@ -75,12 +127,21 @@ class GmailHistory(object):
             creds = tools.run_flow(flow, store)
 
         # build return gmail service object on authentication
-        self.gmail = build(
-            "gmail", "v1", http=creds.authorize(Http()), cache_discovery=False
-        )
+        self.creds = creds
+        self.gmail = self.build_client()
 
         return self.gmail
 
+    def build_client(self):
+        """
+        This fun helps to build a gmail service object with its own http connection,
+        httplib2 is not thread safe so a thread making api calls needs its own client.
+
+        """
+        return build(
+            "gmail", "v1", http=self.creds.authorize(Http()), cache_discovery=False
+        )
+
     def save_files(self, message):
         """
         This fun helps to store gmail attachments from the given message.
@@ -122,7 +183,6 @@ class GmailHistory(object):
         self.log.debug("set_tmp_ts_to_last_msg")
 
         self.dd["last_msg_ts"] = self.dd["tmp_ts"]
-        self.dd.close()
 
     def renew_mailbox_watch(self):
         """Renewing mailbox watch
@@ -133,18 +193,40 @@ class GmailHistory(object):
 
         :ref : https://developers.google.com/gmail/api/guides/push
 
+        >>> import tempfile
+        >>> from mock import Mock
+        >>> obj = GmailHistory(status_path=tempfile.mkdtemp() + '/')
+        >>> obj.gmail, obj.build_client = Mock(), Mock()
+        >>> obj.watch_gmail = Mock(side_effect=StopIteration)
+        >>> obj.renew_mailbox_watch()
+        Traceback (most recent call last):
+        ...
+        StopIteration
+        >>> obj.watch_gmail.call_args[0][0] is obj.build_client.return_value
+        True
+        >>> obj.close()
+
         """
+        # httplib2 is not thread safe, this thread gets its own client
+        gmail = self.build_client()
+
         while True:
-            self.watch_gmail()
+            self.watch_gmail(gmail)
             time.sleep(self.GMAIL_WATCH_DELAY)
 
-    def get_new_msg(self):
+    def get_new_msg(self, collect=False):
         """
         This fun help us to see any changes to the user's mailbox and gives new msgs if they are available.
         Note : startHistoryId - returns Histories(drafts, mail deletions, new mails) after start_history_id.
+        Label changes and deletions are applied to the targets as partial updates,
+        without fetching the msgs again. New msgs are stored page by page and only
+        kept and returned when collect is set.
 
         :calls : GET https://www.googleapis.com/gmail/v1/users/userId/history
 
+        :param collect : bool
+        :rtype : list or None
+
         >>> from mock import Mock, MagicMock
         >>> obj = GmailHistory()
         >>> obj.store_msgs_in_db = Mock()
@@ -153,41 +235,85 @@ class GmailHistory(object):
         >>> obj.dd = MagicMock()
         >>> sample_doc = {'history': [{'messagesAdded': [{'message': {'labelIds': ['UNREAD'], 'id': '163861dac0f17c61'}}]}]}
         >>> obj.gmail.users().history().list().execute = Mock(obj.gmail.users().history().list().execute,return_value=sample_doc)
-        >>> obj.get_new_msg()
+        >>> obj.get_new_msg(collect=True)
         [{'labelIds': ['UNREAD'], 'id': '163861dac0f17c61'}]
 
+        >>> obj.update_labels = Mock()
+        >>> obj.delete_message = Mock()
+        >>> sample_doc = {'history': [{'messagesAdded': [{'message': {'labelIds': ['INBOX'], 'id': '1632163b6a84ab94'}}]},
+        ...     {'labelsRemoved': [{'message': {'id': '163861dac0f17c61'}, 'labelIds': ['UNREAD']}]},
+        ...     {'messagesDeleted': [{'message': {'id': '1632163b6a84ab94'}}]}]}
+        >>> obj.gmail.users().history().list().execute = Mock(obj.gmail.users().history().list().execute,return_value=sample_doc)
+        >>> obj.get_new_msg(collect=True)
+        []
+        >>> obj.update_labels.call_args
+        call('163861dac0f17c61', removed=['UNREAD'])
+        >>> obj.delete_message.call_args
+        call('1632163b6a84ab94')
+
         """
         self.log.debug("get_new_msg")
 
-        msg_list = []
-        new_msg = (
-            self.gmail.users()
-            .history()
-            .list(userId="me", startHistoryId=self.dd["historyId"])
-            .execute()
-        )
-
-        if "history" not in new_msg:
-            return
+        msg_list = [] if collect else None
+        history_id = None
+        has_history = False
 
-        for record in new_msg.get("history"):
+        for page in self.iter_new_history(self.dd["historyId"]):
+            history_id = page.get("historyId", history_id)
+            has_history = has_history or "history" in page
 
-            if "messagesAdded" not in record:
-                continue
+            msgs = self._apply_history_records(page.get("history", []))
+            self.store_msgs_in_db(msgs)
 
-            msg = record.get("messagesAdded")[0]["message"]
+            if collect:
+                msg_list.extend(msgs)
 
-            if msg.get("labelIds")[0] == "DRAFT":
-                continue
+        if not has_history:
+            return
 
-            msg_list.append(msg)
+        if history_id is not None:
+            self.dd["historyId"] = history_id
 
-        self.store_msgs_in_db(msg_list)
         self.set_tmp_ts_to_last_msg()
 
         return msg_list
 
-    def watch_gmail(self):
+    def _apply_history_records(self, records):
+        """
+        This fun helps to apply label changes and deletions to the targets right away,
+        and gives the added msgs which are not deleted with in the same records.
+
+        :param records : list
+        :rtype : list
+
+        """
+        msg_list = []
+        deleted = set()
+
+        for record in records:
+
+            for added in record.get("messagesAdded", []):
+                msg = added["message"]
+
+                if msg.get("labelIds")[0] == "DRAFT":
+                    continue
+
+                msg_list.append(msg)
+
+            for change in record.get("labelsAdded", []):
+                self.update_labels(change["message"]["id"], added=change["labelIds"])
+
+            for change in record.get("labelsRemoved", []):
+                self.update_labels(change["message"]["id"], removed=change["labelIds"])
+
+            for change in record.get("messagesDeleted", []):
+                deleted.add(change["message"]["id"])
+                self.delete_message(change["message"]["id"])
+
+        # msgs deleted after being added can not be fetched anymore
+        return [m for m in msg_list if m["id"] not in deleted]
+
+    def watch_gmail(self, gmail=None):
         """To recive Push Notifications
 
         In order to receive notifications from Cloud Pub/Sub topic,
@@ -209,42 +335,105 @@ class GmailHistory(object):
 
         request = {"labelIds": self.LABELIDS, "topicName": "{}".format(self.topic)}
 
-        hstry_id = self.gmail.users().watch(userId="me", body=request).execute()
+        gmail = gmail or self.gmail
+        hstry_id = gmail.users().watch(userId="me", body=request).execute()
 
         self.log.info("Gmail_watch_id :", hstryid=hstry_id)
 
         return hstry_id
 
-    def send_msgs_to_target(self, target, msg):
+    def write_message(self, msg):
         """
-        This fun helps to send msg to target database and store it.
+        This function helps to push msgs to databases in asynchronous manner, if more than one db is specified.
 
-        :param target : db_obj
-        :param msg : dict
+        :param msg: dict
 
         """
-        self.log.debug("send msgs to tatgets")
+        self.log.debug("write msgs in db")
 
-        target.insert_msg(msg)
+        self.apply_to_targets("insert_msg", msg)
 
-    def write_message(self, msg):
+    def apply_to_targets(self, method, *args):
         """
-        This function helps to push msgs to databases in asynchronous manner, if more than one db is specified.
+        This fun helps to queue the given method call on every target's sink,
+        it does not wait for the targets to finish.
 
-        :param msg: dict
+        :param method : str
+        :param args : arguments for the target method
 
         """
-        self.log.debug("write msgs in db")
+        self.log.debug("apply to targets", method=method)
 
-        if self.targets:
-            fn = self.send_msgs_to_target
+        for sink in self.sinks:
+            sink.put(method, *deepcopy(args))
+
+    def target_stats(self):
+        """
+        This fun helps to get the queued & spooled calls and the lag (in sec) of every target.
 
-            jobs = []
-            for t in self.targets:
-                jobs.append(self._pool.apply_async(fn, (t, deepcopy(msg))))
+        :rtype : dict
+
+        >>> import tempfile
+        >>> class Store(object):
+        ...     def insert_msg(self, msg):
+        ...         pass
+        >>> targets = {'gmaildump.messagestore.FileStore:file_path=/tmp/gmail': Store()}
+        >>> obj = GmailHistory(status_path=tempfile.mkdtemp() + '/', targets=targets)
+        >>> for name, stats in obj.target_stats().items():
+        ...     print("{} {queued} {spooled} {dead}".format(name, **stats))
+        Store-ba4f39147798 0 0 0
+        >>> obj.close()
+
+        """
+        return dict((sink.name, sink.stats()) for sink in self.sinks)
+
+    def update_labels(self, msg_id, added=(), removed=()):
+        """
+        This fun helps to add and remove labels of an already stored msg.
+
+        :param msg_id : str
+        :param added : list
+        :param removed : list
+
+        """
+        self.log.debug("update_labels")
+
+        self.apply_to_targets("update_labels", msg_id, added, removed)
+
+    def delete_message(self, msg_id):
+        """
+        This fun helps to remove a deleted msg from the targets.
+
+        :param msg_id : str
+
+        """
+        self.log.debug("delete_message")
+
+        self.apply_to_targets("delete_msg", msg_id)
+
+    def sync_targets(self):
+        """
+        This fun helps to make every msg sent so far durable for the targets,
+        it does not wait for them to store the msgs.
+
+        """
+        self.log.debug("sync targets")
 
-            for j in jobs:
-                j.wait()
+        for sink in self.sinks:
+            sink.sync()
+
+    def close(self):
+        """
+        This fun helps to stop the target workers, spooling the msgs they still have queued,
+        and to close the diskdict.
+
+        """
+        self.log.debug("close")
+
+        for sink in self.sinks:
+            sink.close()
+
+        self.dd.close()
 
     def change_diskdict_state(self, message):
         """
@@ -268,24 +457,86 @@ class GmailHistory(object):
         Get msg ids from list of messages amd makes an api call with the msg id
         and store in db.
 
+        The diskdict state only moves past the msgs once the targets stored or spooled them,
+        so a crash in between makes them to be fetched again instead of being skipped.
+
         :params msgs_list : list
         :calls : GET https://www.googleapis.com/gmail/v1/users/userId/messages/id
 
+        >>> from mock import Mock
+        >>> obj = GmailHistory()
+        >>> obj.gmail = Mock()
+        >>> obj.gmail.users().messages().get().execute = Mock(return_value={'id': '163861dac0f17c61', 'internalDate': '1526901630000', 'historyId': '1234'})
+        >>> obj.dd = {}
+        >>> obj.sync_targets = Mock(side_effect=IOError)
+        >>> obj.store_msgs_in_db([{'id': '163861dac0f17c61'}])
+        Traceback (most recent call last):
+        ...
+        IOError
+        >>> obj.dd
+        {}
+        >>> obj.sync_targets = Mock()
+        >>> obj.store_msgs_in_db([{'id': '163861dac0f17c61'}])
+        >>> obj.dd['last_msg_ts'], obj.dd['historyId']
+        ('1526901630000', '1234')
+
+        A slow target does not hold back the fetching, what it has not taken yet is spooled.
+
+        >>> import tempfile
+        >>> class SlowStore(object):
+        ...     def insert_msg(self, msg):
+        ...         time.sleep(0.5)
+        >>> obj = GmailHistory(status_path=tempfile.mkdtemp() + '/', targets={'slow': SlowStore()})
+        >>> obj.gmail = Mock()
+        >>> obj.gmail.users().messages().get().execute = Mock(return_value={'id': '163861dac0f17c61', 'internalDate': '1526901630000', 'historyId': '1234'})
+        >>> ts = time.time()
+        >>> obj.store_msgs_in_db([{'id': '163861dac0f17c61'}] * 3)
+        >>> time.time() - ts < 0.5
+        True
+        >>> obj.dd['historyId']
+        '1234'
+        >>> obj.close()
+
         """
         self.log.debug("store_msgs_in_db")
 
+        states = []
         for msg in msgs_list:
 
-            message = (
-                self.gmail.users().messages().get(userId="me", id=msg["id"]).execute()
-            )
+            try:
+                message = (
+                    self.gmail.users()
+                    .messages()
+                    .get(userId="me", id=msg["id"])
+                    .execute()
+                )
+            except HttpError as e:
+                # deleted since it was listed, its delete event reaches the targets later
+                if e.resp.status != 404:
+                    raise
+
+                self.log.info("msg not found, skipping", msg_id=msg["id"])
+                continue
 
             self.write_message(message)
-            self.change_diskdict_state(message)
+            states.append(
+                dict(
+                    internalDate=message["internalDate"],
+                    historyId=message["historyId"],
+                )
+            )
 
             if self.file_path:
                 self.save_files(message)
 
+        self.sync_targets()
+
+        for state in states:
+            self.change_diskdict_state(state)
+
+        if self.sinks:
+            self.log.info("target stats", stats=self.target_stats())
+
     def get_default_ts(self):
         """
         This fun helps to return next day date from today in Y/m/d format
@@ -297,9 +548,10 @@ class GmailHistory(object):
 
         return (datetime.now() + timedelta(days=1)).strftime("%Y/%m/%d")
 
-    def get_history(self, before, after=GMAIL_CREATED_TS):
+    def iter_history_pages(self, before, after=GMAIL_CREATED_TS):
         """
-        Get all the msgs from the user's mailbox with in given dates and store in the db
+        Yields the msgs of the user's mailbox with in given dates, one api page at a time.
+        Only the current page is held in memory, so the whole mailbox can be walked in constant memory.
         Note : Gmail api will consider 'before' : excluded date, 'after' : included date
         Eg: before : 2017/01/01, after : 2017/01/31 then gmail api gives msgs from 2017/01/02 - 2017/01/31
 
@@ -308,7 +560,99 @@ class GmailHistory(object):
 
         :param before : string
         :param after : string
-        :rtype : list
+        :rtype : generator of lists
+
+        >>> from mock import Mock
+        >>> obj = GmailHistory()
+        >>> obj.gmail = Mock()
+        >>> api_docs = [{'messages':[{'id':'163861dac0f17c61'}], 'nextPageToken':'1'}, {'messages':[{'id':'1632163b6a84ab94'}]}]
+        >>> obj.gmail.users().messages().list().execute = Mock(obj.gmail.users().messages().list().execute, side_effect=api_docs)
+        >>> list(obj.iter_history_pages('2017/05/10'))
+        [[{'id': '163861dac0f17c61'}], [{'id': '1632163b6a84ab94'}]]
+
+        """
+        self.log.debug("iter_history_pages")
+
+        query = "{} before:{} after:{}".format(self.query, before, after)
+        params = dict(userId="me", maxResults=self.MAX_RESULTS, q=query)
+
+        while True:
+            response = self.gmail.users().messages().list(**params).execute()
+
+            if response.get("messages"):
+                yield response["messages"]
+
+            if "nextPageToken" not in response:
+                break
+
+            params["pageToken"] = response["nextPageToken"]
+
+    def iter_history(self, before, after=GMAIL_CREATED_TS):
+        """
+        Yields the msgs of the user's mailbox with in given dates, one at a time.
+
+        :param before : string
+        :param after : string
+        :rtype : generator of dicts
+
+        >>> from mock import Mock
+        >>> obj = GmailHistory()
+        >>> obj.gmail = Mock()
+        >>> api_docs = [{'messages':[{'id':'163861dac0f17c61'}], 'nextPageToken':'1'}, {'messages':[{'id':'1632163b6a84ab94'}]}]
+        >>> obj.gmail.users().messages().list().execute = Mock(obj.gmail.users().messages().list().execute, side_effect=api_docs)
+        >>> list(obj.iter_history('2017/05/10'))
+        [{'id': '163861dac0f17c61'}, {'id': '1632163b6a84ab94'}]
+
+        """
+        self.log.debug("iter_history")
+
+        for msgs in self.iter_history_pages(before, after):
+            for msg in msgs:
+                yield msg
+
+    def iter_new_history(self, start_history_id):
+        """
+        Yields the history pages of the user's mailbox after start_history_id, one api page at a time.
+
+        :calls : GET https://www.googleapis.com/gmail/v1/users/userId/history
+
+        :param start_history_id : string
+        :rtype : generator of dicts
+
+        >>> from mock import Mock, call
+        >>> obj = GmailHistory()
+        >>> obj.gmail = Mock()
+        >>> api_docs = [{'history':[{'id':'1235'}], 'nextPageToken':'1'}, {'history':[{'id':'1236'}], 'historyId':'1236'}]
+        >>> obj.gmail.users().history().list().execute = Mock(obj.gmail.users().history().list().execute, side_effect=api_docs)
+        >>> [page['history'] for page in obj.iter_new_history('1234')]
+        [[{'id': '1235'}], [{'id': '1236'}]]
+        >>> obj.gmail.users().history().list.call_args == call(userId='me', startHistoryId='1234', pageToken='1')
+        True
+
+        """
+        self.log.debug("iter_new_history")
+
+        params = dict(userId="me", startHistoryId=start_history_id)
+
+        while True:
+            response = self.gmail.users().history().list(**params).execute()
+
+            yield response
+
+            if "nextPageToken" not in response:
+                break
+
+            params["pageToken"] = response["nextPageToken"]
+
+    def get_history(self, before, after=GMAIL_CREATED_TS, collect=False):
+        """
+        Get all the msgs from the user's mailbox with in given dates and store in the db, page by page.
+        The msg stubs are only kept and returned when collect is set.
+
+        :param before : string
+        :param after : string
+        :param collect : bool
+        :rtype : list or None
 
         >>> from mock import Mock
         >>> obj = GmailHistory()
@@ -316,44 +660,19 @@ class GmailHistory(object):
         >>> api_doc = {'messages':[{'id':'163861dac0f17c61'},{'id':'1632163b6a84ab94'}]}
         >>> obj.gmail.users().messages().list().execute = Mock(obj.gmail.users().messages().list().execute, return_value=api_doc)
         >>> obj.store_msgs_in_db = Mock()
-        >>> obj.get_history('2017/05/10')
+        >>> obj.get_history('2017/05/10', collect=True)
         [{'id': '163861dac0f17c61'}, {'id': '1632163b6a84ab94'}]
 
         """
         self.log.debug("fun get history")
 
-        query = "{} before:{} after:{}".format(self.query, before, after)
-        response = (
-            self.gmail.users()
-            .messages()
-            .list(userId="me", maxResults=self.MAX_RESULTS, q=query)
-            .execute()
-        )
-        msgs = []
-        response = AttrDict(response)
+        msgs = [] if collect else None
 
-        if "messages" in response:
-            msgs.extend(response.messages)
-            self.store_msgs_in_db(response.messages)
-
-        while "nextPageToken" in response:
-            page_token = response.nextPageToken
-            response = (
-                self.gmail.users()
-                .messages()
-                .list(
-                    userId="me",
-                    maxResults=self.MAX_RESULTS,
-                    q=query,
-                    pageToken=page_token,
-                )
-                .execute()
-            )
-            response = AttrDict(response)
+        for page in self.iter_history_pages(before, after):
+            self.store_msgs_in_db(page)
 
-            if response.resultSizeEstimate is not 0:
-                msgs.extend(response.messages)
-                self.store_msgs_in_db(response.messages)
+            if collect:
+                msgs.extend(page)
 
         return msgs
 
@@ -1,16 +1,65 @@
 import hashlib
 import json
+import zlib
 
 import gnsq
 import sqlite3
 from deeputil import Dummy
 from diskdict import DiskDict
-from pymongo import MongoClient
+from bson.binary import Binary
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from bson.errors import InvalidDocument
 
-DUMMY_LOG = Dummy
+import util
+
+DUMMY_LOG = Dummy()
+
+
+class InvalidMsg(Exception):
+    """
+    Raised when a store refuses a msg for what it is, retrying it would not help.
+
+    """
+
+
+def label_event(msg_id, added=(), removed=()):
+    return dict(
+        event="labels", id=msg_id, labelsAdded=list(added), labelsRemoved=list(removed)
+    )
+
+
+def delete_event(msg_id):
+    return dict(event="deleted", id=msg_id)
 
 
 class SQLiteStore(object):
+    """
+    Stores messages as json in a sqlite table keyed by the gmail `id`.
+
+    >>> store = SQLiteStore(":memory:")
+    >>> store.insert_msg({"id": "163861dac0f17c61", "labelIds": ["INBOX", "UNREAD"]})
+    >>> labels = lambda: json.loads(
+    ...     store.db.execute("SELECT message FROM gmail_dump").fetchone()[0]
+    ... )["labelIds"]
+    >>> store.update_labels("163861dac0f17c61", added=["IMPORTANT"], removed=["UNREAD"])
+    >>> print(" ".join(labels()))
+    INBOX IMPORTANT
+    >>> store.update_labels("163861dac0f17c61", added=["INBOX"])
+    >>> print(" ".join(labels()))
+    INBOX IMPORTANT
+    >>> store.update_labels("1632163b6a84ab94", added=["INBOX"])
+    >>> store.db.execute("SELECT count(*) FROM gmail_dump").fetchone()[0]
+    1
+    >>> store.delete_msg("163861dac0f17c61")
+    >>> store.db.execute("SELECT count(*) FROM gmail_dump").fetchone()[0]
+    0
+
+    """
+
+    # failures of the msg itself, retrying it would not help
+    PERMANENT_ERRORS = (sqlite3.IntegrityError,)
+
     def __init__(self, db_name="Gmail", table_name="gmail_dump", log=DUMMY_LOG):
         self.db_name = db_name
         self.table_name = table_name
@@ -28,24 +77,78 @@ class SQLiteStore(object):
     def insert_msg(self, record):
         self.log.info("Msg inserting in sqlite store", record=record["id"])
 
-        try:
-            self.db.execute(
-                "INSERT INTO {t} VALUES (?, ?)".format(t=self.table_name),
-                (record["id"], json.dumps(record)),
-            )
-        except Exception as e:
-            self.log.exception(e)
+        # replace keeps a replayed msg from failing on the unique key
+        self.db.execute(
+            "INSERT OR REPLACE INTO {t} VALUES (?, ?)".format(t=self.table_name),
+            (record["id"], json.dumps(record)),
+        )
+
+    def update_labels(self, msg_id, added=(), removed=()):
+        self.log.info("Msg labels updating in sqlite store", record=msg_id)
+
+        row = self.db.execute(
+            "SELECT message FROM {t} WHERE key = ?".format(t=self.table_name),
+            (msg_id,),
+        ).fetchone()
+
+        if not row:
+            return
+
+        record = json.loads(row[0])
+        labels = [l for l in record.get("labelIds", []) if l not in removed]
+        labels.extend(l for l in added if l not in labels)
+        record["labelIds"] = labels
+
+        self.db.execute(
+            "UPDATE {t} SET message = ? WHERE key = ?".format(t=self.table_name),
+            (json.dumps(record), msg_id),
+        )
+
+    def delete_msg(self, msg_id):
+        self.log.info("Msg deleting in sqlite store", record=msg_id)
+
+        self.db.execute(
+            "DELETE FROM {t} WHERE key = ?".format(t=self.table_name), (msg_id,)
+        )
 
 
 class FileStore(object):
+    """
+    Appends messages, label changes and deletions to a file as json lines.
+
+    >>> import tempfile
+    >>> store = FileStore(tempfile.mkstemp()[1])
+    >>> store.insert_msg({"id": "163861dac0f17c61"})
+    >>> store.update_labels("163861dac0f17c61", added=["IMPORTANT"], removed=["UNREAD"])
+    >>> store.delete_msg("163861dac0f17c61")
+    >>> for l in open(store.p):
+    ...     e = json.loads(l)
+    ...     print(" ".join([e.get("event", "msg"), e["id"]] + e.get("labelsAdded", []) + e.get("labelsRemoved", [])))
+    msg 163861dac0f17c61
+    labels 163861dac0f17c61 IMPORTANT UNREAD
+    deleted 163861dac0f17c61
+
+    """
+
     def __init__(self, file_path=None, log=DUMMY_LOG):
         self.p = file_path
         self.log = log
 
-    def insert_msg(self, msg):
-        self.log.info("Msg inserting in file store", record=record["id"])
+    def _write(self, record):
         with open(self.p, "a") as _file:
-            _file.write(msg)
+            _file.write(json.dumps(record) + "\n")
+
+    def insert_msg(self, msg):
+        self.log.info("Msg inserting in file store", record=msg["id"])
+        self._write(msg)
+
+    def update_labels(self, msg_id, added=(), removed=()):
+        self.log.info("Msg labels event in file store", record=msg_id)
+        self._write(label_event(msg_id, added, removed))
+
+    def delete_msg(self, msg_id):
+        self.log.info("Msg deleted event in file store", record=msg_id)
+        self._write(delete_event(msg_id))
 
 
 class NsqStore(object):
@@ -60,19 +163,168 @@ class NsqStore(object):
         self.connection.publish(self.topic, json.dumps(record))
         self.log.info("msg inserted in nsq store", record=record["id"])
 
+    def update_labels(self, msg_id, added=(), removed=()):
+        self.connection.publish(
+            self.topic, json.dumps(label_event(msg_id, added, removed))
+        )
+        self.log.info("msg labels event sent to nsq store", record=msg_id)
+
+    def delete_msg(self, msg_id):
+        self.connection.publish(self.topic, json.dumps(delete_event(msg_id)))
+        self.log.info("msg deleted event sent to nsq store", record=msg_id)
+
 
 class MongoStore(object):
-    def __init__(self, db_name, collection_name, log=DUMMY_LOG):
+    """
+    Stores messages in a mongo collection.
+
+    Messages are upserted on their gmail `id`, which carries a unique index,
+    so every write is an index lookup instead of a collection scan. Messages
+    given together to `insert_msgs` are sent as unordered bulk upserts of
+    `batch_size` messages.
+
+    All the arguments other than `log` come from the command line, hence
+    the string defaults.
+
+    :param uri : mongodb connection uri
+    :param max_pool_size : max connections kept in the client pool
+    :param w : write concern, a number of nodes or a tag such as `majority`
+    :param journal : wait for the journal commit on every write
+    :param batch_size : number of messages sent in one bulk upsert
+    :param compress : store the `payload` field zlib compressed
+
+    >>> import sys
+    >>> from mock import patch
+    >>> with patch.object(sys.modules[MongoStore.__module__], "MongoClient"):
+    ...     store = MongoStore("gmail", "gmail_dump")
+    >>> for c in store.db.create_index.call_args_list:
+    ...     print(c)
+    call([('id', 1)], unique=True)
+    call([('threadId', 1)])
+    call([('internalDate', 1)])
+    >>> store.insert_msgs([{"id": "163861dac0f17c61"}, {"id": "1632163b6a84ab94"}])
+    >>> bulk = store.db.initialize_unordered_bulk_op.return_value
+    >>> bulk.find.call_args_list
+    [call({'id': '163861dac0f17c61'}), call({'id': '1632163b6a84ab94'})]
+    >>> bulk.find.return_value.upsert.return_value.replace_one.call_args_list
+    [call({'id': '163861dac0f17c61'}), call({'id': '1632163b6a84ab94'})]
+    >>> bulk.execute.call_count
+    1
+    >>> from pymongo.errors import BulkWriteError
+    >>> dup = {"writeErrors": [{"index": 0, "code": 11000}]}
+    >>> bulk.execute.side_effect = BulkWriteError(dup)
+    >>> store.insert_msgs([{"id": "163861dac0f17c61"}])
+    Traceback (most recent call last):
+    ...
+    InvalidMsg: [{'index': 0, 'code': 11000}]
+    >>> wc = {"writeErrors": [], "writeConcernErrors": [{"code": 64}]}
+    >>> bulk.execute.side_effect = BulkWriteError(wc)
+    >>> store.insert_msgs([{"id": "163861dac0f17c61"}])
+    Traceback (most recent call last):
+    ...
+    BulkWriteError: batch op errors occurred
+    >>> with patch.object(sys.modules[MongoStore.__module__], "MongoClient") as client:
+    ...     store = MongoStore("gmail", "gmail_dump", w=2)
+    >>> client.call_args[1]["w"]
+    2
+
+    """
+
+    INDEXES = ("threadId", "internalDate")
+
+    # failures of the msg itself, anything else (outages, auth, stepdowns) is retried
+    PERMANENT_ERRORS = (InvalidMsg, InvalidDocument)
+
+    # server error codes caused by the msg itself: BadValue, DollarPrefixedFieldName,
+    # InvalidDBRef, EmptyFieldName, DottedFieldName, BSONObjectTooLarge, duplicate key
+    # and an array modifier on a field which is not an array
+    INVALID_MSG_CODES = (2, 52, 55, 56, 57, 10334, 11000, 11001, 16837)
+
+    def __init__(
+        self,
+        db_name,
+        collection_name,
+        uri="mongodb://localhost:27017",
+        max_pool_size="100",
+        w="1",
+        journal="false",
+        batch_size="500",
+        compress="false",
+        log=DUMMY_LOG,
+    ):
         self.db_name = db_name
         self.collection_name = collection_name
         self.log = log
-        self.client = MongoClient()
+        self.batch_size = int(batch_size)
+        self.compress = util.str2bool(compress)
+
+        w = int(w) if str(w).isdigit() else w
+        self.client = MongoClient(
+            uri, max_pool_size=int(max_pool_size), w=w, j=util.str2bool(journal)
+        )
         self.db = self.client[self.db_name][self.collection_name]
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        self.db.create_index([("id", ASCENDING)], unique=True)
+
+        for field in self.INDEXES:
+            self.db.create_index([(field, ASCENDING)])
+
+    def _prepare(self, msg):
+        # the caller may still spool msg, so it is left as it was
+        msg = dict(msg)
+
+        if self.compress and "payload" in msg:
+            msg["payload"] = Binary(zlib.compress(json.dumps(msg["payload"])))
+
+        return msg
 
     def insert_msg(self, msg):
-        self.log.info("Msg inserted in monog db", msg_id=msg["id"])
+        self.insert_msgs([msg])
+
+    def insert_msgs(self, msgs):
+        for i in range(0, len(msgs), self.batch_size):
+            batch = msgs[i : i + self.batch_size]
+
+            bulk = self.db.initialize_unordered_bulk_op()
+            for msg in batch:
+                bulk.find({"id": msg["id"]}).upsert().replace_one(self._prepare(msg))
+
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                self.log.exception(e, details=e.details)
+                codes = [err.get("code") for err in e.details.get("writeErrors", [])]
+
+                # write concern errors and server failures retry the whole batch
+                if e.details.get("writeConcernErrors") or not codes:
+                    raise
+                if any(c not in self.INVALID_MSG_CODES for c in codes):
+                    raise
+
+                raise InvalidMsg(e.details["writeErrors"])
+
+            self.log.info("Msgs inserted in monog db", count=len(batch))
+
+    def update_labels(self, msg_id, added=(), removed=()):
+        self.log.info("Msg labels updated in monog db", msg_id=msg_id)
 
         try:
-            self.db.update({"id": msg["id"]}, msg, upsert=True)
-        except Exception as e:
-            self.log.exception(e)
+            if added:
+                self.db.update(
+                    {"id": msg_id}, {"$addToSet": {"labelIds": {"$each": list(added)}}}
+                )
+            if removed:
+                self.db.update(
+                    {"id": msg_id}, {"$pullAll": {"labelIds": list(removed)}}
+                )
+        except OperationFailure as e:
+            if e.code in self.INVALID_MSG_CODES:
+                raise InvalidMsg(str(e))
+            raise
+
+    def delete_msg(self, msg_id):
+        self.log.info("Msg deleted in monog db", msg_id=msg_id)
+
+        self.db.remove({"id": msg_id})
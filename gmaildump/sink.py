@@ -0,0 +1,516 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import deque
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class TargetSink(object):
+    """
+    Delivers store calls (insert_msg, update_labels, ...) to one target from its own worker thread.
+
+    Calls are kept in a bounded in-memory queue. When the queue is full, the target fails
+    or sync() is called, calls are appended to segment files under spool_path and replayed
+    in order once the target accepts writes again, so a slow or down target never holds back
+    the others. The calls being delivered are kept in a journal file till they are done.
+    Calls failing with an error no retry can fix go to a dead letter file instead.
+
+    Only one sink can use a spool_path at a time, the spool dir is locked.
+
+    >>> import tempfile
+    >>> class Target(object):
+    ...     def __init__(self):
+    ...         self.msgs = []
+    ...     def insert_msg(self, msg):
+    ...         self.msgs.append(msg["id"])
+    >>> path = tempfile.mkdtemp()
+    >>> sink = TargetSink(Target(), path, maxsize=1)
+    >>> for i in range(3):
+    ...     sink.put("insert_msg", {"id": i})
+    >>> sink.stats()["queued"], sink.stats()["spooled"]
+    (1, 2)
+    >>> sink.step(); sink.step()
+    >>> sink.target.msgs, sink.stats()["spooled"], sink.stats()["spool_bytes"]
+    ([0, 1, 2], 0, 0)
+    >>> TargetSink(Target(), path)
+    Traceback (most recent call last):
+    ...
+    IOError: spool dir is in use by another sink
+    >>> sink.close()
+
+    """
+
+    SEGMENT_SIZE = 1000  # calls per spool segment file
+    RETRY_DELAY = 5  # time in sec to wait before retrying a failed target
+    POLL_TIMEOUT = 1  # time in sec the worker waits on an empty queue
+    DEAD_LETTER = "dead.letter"  # file of calls which failed with a permanent error
+    JOURNAL = "inflight.journal"  # file of the calls being delivered
+
+    # errors which no retry can fix, only targets know which of theirs are, with
+    # PERMANENT_ERRORS, anything else is retried
+    PERMANENT_ERRORS = ()
+
+    def __init__(self, target, spool_path, maxsize=1000, log=DUMMY_LOG):
+        self.target = target
+        self.name = os.path.basename(spool_path.rstrip(os.sep))
+        self.spool_path = spool_path
+        self.log = log
+        self.maxsize = int(maxsize)
+        self.batch_size = int(getattr(target, "batch_size", 1))
+        self.permanent_errors = self.PERMANENT_ERRORS + tuple(
+            getattr(target, "PERMANENT_ERRORS", ())
+        )
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._wfile = None  # segment file which is being appended
+        self._wcount = 0
+        self._current_ts = None
+        self._thread = None
+
+        if not os.path.exists(spool_path):
+            os.makedirs(spool_path)
+
+        # two sinks on one spool dir would replay the same segments
+        self._lockfile = open(os.path.join(spool_path, "lock"), "w")
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self._lockfile.close()
+            raise IOError("spool dir is in use by another sink")
+
+        # calls spooled by a previous run are replayed first
+        segments = self._segments()
+        self._seq = int(segments[-1].split(".")[0]) + 1 if segments else 0
+        self.spooled = sum(self._count(s) for s in segments)
+        self.spool_bytes = sum(
+            os.path.getsize(os.path.join(spool_path, s)) for s in segments
+        )
+
+        # calls which were being delivered when the process died go before them
+        journal_path = os.path.join(spool_path, self.JOURNAL)
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                self._write_head(f.readlines())
+            os.remove(journal_path)
+
+        dead_path = os.path.join(spool_path, self.DEAD_LETTER)
+        self.dead = self._count(self.DEAD_LETTER) if os.path.exists(dead_path) else 0
+
+    def start(self):
+        th = threading.Thread(target=self.run)
+        th.daemon = True
+        th.start()
+        self._thread = th
+
+    def close(self):
+        """
+        Stops the worker and spools whatever is still queued, so nothing is lost on exit.
+
+        >>> import tempfile
+        >>> class Target(object):
+        ...     def insert_msg(self, msg):
+        ...         pass
+        >>> path = tempfile.mkdtemp()
+        >>> sink = TargetSink(Target(), path)
+        >>> for i in range(3):
+        ...     sink.put("insert_msg", {"id": i})
+        >>> sink.close()
+        >>> sink = TargetSink(Target(), path)
+        >>> sink.stats()["spooled"], sink._seq
+        (3, 1)
+        >>> sink.put("insert_msg", {"id": 3})
+        >>> sorted(os.listdir(path))
+        ['00000000000000000000.seg', '00000000000000000001.seg', 'lock']
+        >>> sink.step(); sink.step()
+        >>> sink.stats()["spooled"], sorted(os.listdir(path))
+        (0, ['lock'])
+        >>> sink.close()
+
+        """
+        self._stop.set()
+        if self._thread:
+            # a call still in flight after this stays in the journal
+            self._thread.join(self.RETRY_DELAY)
+
+        with self._lock:
+            self._spill()
+            self._close_segment()
+
+        fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+        self._lockfile.close()
+
+    def put(self, method, *args):
+        """
+        Queues a call of target.method(*args), it goes to the spool when the queue is full
+        or when older calls are still spooled.
+
+        :param method : str
+
+        """
+        item = (time.time(), method, args)
+
+        with self._lock:
+            if not self.spooled:
+                if len(self._queue) < self.maxsize:
+                    self._queue.append(item)
+                    self._cond.notify()
+                    return
+
+                self.log.warning("target queue is full, spooling", target=self.name)
+
+            self._spool(item)
+
+    def sync(self):
+        """
+        Makes every call put so far durable without waiting for the target,
+        the queued calls are spooled and the ones being delivered are in the journal.
+
+        >>> import tempfile
+        >>> class Target(object):
+        ...     def __init__(self):
+        ...         self.msgs = []
+        ...     def insert_msg(self, msg):
+        ...         self.msgs.append(msg["id"])
+        >>> path = tempfile.mkdtemp()
+        >>> sink = TargetSink(Target(), path)
+        >>> sink.put("insert_msg", {"id": 0})
+        >>> with sink._lock:
+        ...     taken = sink._take()
+        >>> sink.put("insert_msg", {"id": 1})
+        >>> sink.sync()
+        >>> sink.stats()["queued"], sink.stats()["spooled"]
+        (0, 1)
+
+        The process dies while {"id": 0} is being delivered, it is replayed first.
+
+        >>> sink._lockfile.close()
+        >>> sink = TargetSink(Target(), path)
+        >>> sink.stats()["spooled"]
+        2
+        >>> sink.step(); sink.step()
+        >>> sink.target.msgs
+        [0, 1]
+        >>> sink.close()
+
+        """
+        with self._lock:
+            self._spill()
+
+    def stats(self):
+        with self._lock:
+            queued = len(self._queue)
+            pending = queued + self.spooled
+            lag = time.time() - self._current_ts if pending and self._current_ts else 0
+
+            return dict(
+                queued=queued,
+                spooled=self.spooled,
+                spool_bytes=self.spool_bytes,
+                dead=self.dead,
+                lag=lag,
+            )
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                # a dead worker would silently stop the target from getting data
+                self.log.exception(e, target=self.name)
+                self._stop.wait(self.RETRY_DELAY)
+
+        with self._lock:
+            self._cond.notify_all()
+
+    def step(self):
+        """
+        Delivers the next queued calls, or the oldest spool segment when nothing is queued.
+
+        >>> import tempfile
+        >>> class Target(object):
+        ...     def __init__(self):
+        ...         self.msgs = []
+        ...         self.down = False
+        ...     def insert_msg(self, msg):
+        ...         if self.down:
+        ...             raise IOError("target is down")
+        ...         self.msgs.append(msg["id"])
+        >>> path = tempfile.mkdtemp()
+        >>> sink = TargetSink(Target(), path, maxsize=2)
+        >>> sink.RETRY_DELAY = 0
+        >>> for i in range(4):
+        ...     sink.put("insert_msg", {"id": i})
+        >>> sink.target.down = True
+        >>> sink.step()
+        >>> sorted(os.listdir(path))
+        ['00000000000000000000.0.seg', '00000000000000000000.seg', 'lock']
+        >>> sink.stats()["queued"], sink.stats()["spooled"]
+        (0, 4)
+        >>> sink.target.down = False
+        >>> sink.step(); sink.step()
+        >>> sink.target.msgs, sink.stats()["spooled"], sink.stats()["spool_bytes"]
+        ([0, 1, 2, 3], 0, 0)
+        >>> sink.close()
+
+        """
+        with self._lock:
+            if not self._queue and not self.spooled:
+                self._cond.wait(self.POLL_TIMEOUT)
+                return
+
+            # queued calls are always older than the spooled ones
+            items = self._take()
+
+        if not items:
+            if not self._replay():
+                self._stop.wait(self.RETRY_DELAY)
+            return
+
+        done = self._deliver(items)
+
+        with self._lock:
+            if done < len(items):
+                self._spill(items[done:])
+            os.remove(os.path.join(self.spool_path, self.JOURNAL))
+
+        if done < len(items):
+            self._stop.wait(self.RETRY_DELAY)
+
+    def _take(self):
+        """
+        Takes the next calls off the queue, consecutive inserts up to batch_size,
+        and journals them so they are not lost while being delivered.
+
+        """
+        # caller must hold self._lock
+        items = []
+        while self._queue and len(items) < self.batch_size:
+            items.append(self._queue.popleft())
+            if items[-1][1] != "insert_msg":
+                break
+
+        if items:
+            with open(os.path.join(self.spool_path, self.JOURNAL), "w") as f:
+                f.writelines(json.dumps(i) + "\n" for i in items)
+
+        return items
+
+    def _deliver(self, items, batch=True):
+        """
+        Calls the target for items in order, consecutive inserts go in one insert_msgs call
+        when the target has it. Returns how many items are done, a call failing with a
+        permanent error, or for a method the target does not have, is done once it is in the
+        dead letter file.
+
+        >>> import tempfile
+        >>> class Target(object):
+        ...     batch_size = 3
+        ...     PERMANENT_ERRORS = (ValueError,)
+        ...     def __init__(self):
+        ...         self.calls = []
+        ...     def insert_msgs(self, msgs):
+        ...         if any(m["id"] is None for m in msgs):
+        ...             raise ValueError("msg without id")
+        ...         self.calls.append([m["id"] for m in msgs])
+        ...     def insert_msg(self, msg):
+        ...         self.insert_msgs([msg])
+        ...     def delete_msg(self, msg_id):
+        ...         self.calls.append(msg_id)
+        >>> sink = TargetSink(Target(), tempfile.mkdtemp())
+        >>> items = [(0, "insert_msg", [{"id": i}]) for i in (0, 1, None, 3, 4)]
+        >>> sink._deliver(items + [(0, "delete_msg", [0]), (0, "update_labels", [0])])
+        7
+        >>> sink.target.calls
+        [[0], [1], [3, 4], 0]
+        >>> sink.stats()["dead"]
+        2
+        >>> sink.close()
+
+        """
+        done = 0
+        while done < len(items):
+            n = 1
+            if batch and hasattr(self.target, "insert_msgs"):
+                while (
+                    done + n < len(items)
+                    and n < self.batch_size
+                    and items[done][1] == items[done + n][1] == "insert_msg"
+                ):
+                    n += 1
+
+            group = items[done : done + n]
+            ts, method, args = group[0]
+            self._current_ts = ts
+
+            if not hasattr(self.target, method):
+                self.log.error(
+                    "target has no such method", target=self.name, method=method
+                )
+                self._dead_letter(group[0], AttributeError(method))
+                done += n
+                continue
+
+            try:
+                if n > 1:
+                    self.target.insert_msgs([i[2][0] for i in group])
+                else:
+                    getattr(self.target, method)(*args)
+            except Exception as e:
+                if not isinstance(e, self.permanent_errors):
+                    self.log.exception(e, target=self.name, method=method)
+                    break
+
+                if n > 1:
+                    # one of them is bad, they go one by one to find it
+                    d = self._deliver(group, batch=False)
+                    done += d
+                    if d < n:
+                        break
+                    continue
+
+                self.log.exception(e, target=self.name, method=method, dead=True)
+                self._dead_letter(group[0], e)
+
+            done += n
+
+        return done
+
+    def _dead_letter(self, item, e):
+        with self._lock:
+            with open(os.path.join(self.spool_path, self.DEAD_LETTER), "a") as f:
+                f.write(json.dumps(dict(item=item, error=repr(e))) + "\n")
+            self.dead += 1
+
+    def _spill(self, items=()):
+        """
+        Moves the given calls and everything queued after them to the spool, keeping the order.
+
+        """
+        # caller must hold self._lock
+        self._write_head(
+            [json.dumps(i) + "\n" for i in list(items) + list(self._queue)]
+        )
+        self._queue.clear()
+
+    def _write_head(self, lines):
+        # caller must hold self._lock
+        if not lines:
+            return
+
+        segments = self._segments()
+        if segments:
+            # spooled calls are newer than these,
+            # so they go to a segment which sorts before the oldest one
+            name = segments[0][:-4] + ".0.seg"
+        else:
+            name = "{:020d}.seg".format(self._seq)
+            self._seq += 1
+
+        with open(os.path.join(self.spool_path, name), "a") as f:
+            f.writelines(lines)
+
+        self.spooled += len(lines)
+        self.spool_bytes += sum(len(l) for l in lines)
+
+    def _segments(self):
+        return sorted(s for s in os.listdir(self.spool_path) if s.endswith(".seg"))
+
+    def _count(self, name):
+        with open(os.path.join(self.spool_path, name)) as f:
+            return sum(1 for _ in f)
+
+    def _close_segment(self):
+        if self._wfile:
+            self._wfile.close()
+            self._wfile = None
+
+    def _spool(self, item):
+        # caller must hold self._lock
+        if not self._wfile or self._wcount >= self.SEGMENT_SIZE:
+            self._close_segment()
+            path = os.path.join(self.spool_path, "{:020d}.seg".format(self._seq))
+            self._wfile = open(path, "a")
+            self._wcount = 0
+            self._seq += 1
+
+        line = json.dumps(item) + "\n"
+        self._wfile.write(line)
+        self._wfile.flush()
+        self._wcount += 1
+        self.spooled += 1
+        self.spool_bytes += len(line)
+
+    def _replay(self):
+        """
+        Delivers the calls of the oldest spool segment.
+        Returns False when the target failed, the undelivered calls stay in the segment.
+
+        >>> import tempfile
+        >>> class Target(object):
+        ...     def __init__(self):
+        ...         self.msgs = []
+        ...         self.down = False
+        ...     def insert_msg(self, msg):
+        ...         if self.down and msg["id"] == 2:
+        ...             raise IOError("target is down")
+        ...         self.msgs.append(msg["id"])
+        >>> path = tempfile.mkdtemp()
+        >>> sink = TargetSink(Target(), path, maxsize=1)
+        >>> for i in range(5):
+        ...     sink.put("insert_msg", {"id": i})
+        >>> sink.step()
+        >>> sink.target.down = True
+        >>> sink._replay()
+        False
+        >>> sink.target.msgs, sink.stats()["spooled"]
+        ([0, 1], 3)
+        >>> sink._count("00000000000000000000.seg")
+        3
+        >>> sink.stats()["spool_bytes"] == os.path.getsize(os.path.join(path, "00000000000000000000.seg"))
+        True
+        >>> sink.target.down = False
+        >>> sink._replay()
+        True
+        >>> sink.target.msgs, sink.stats()["spooled"], sink.stats()["spool_bytes"]
+        ([0, 1, 2, 3, 4], 0, 0)
+        >>> sink.close()
+
+        """
+        with self._lock:
+            segments = self._segments()
+            if not segments:
+                self.spooled = self.spool_bytes = 0
+                return True
+
+            path = os.path.join(self.spool_path, segments[0])
+
+            # puts go to a new segment while this one is replayed
+            if self._wfile and self._wfile.name == path:
+                self._close_segment()
+
+        with open(path) as f:
+            lines = f.readlines()
+
+        done = self._deliver([json.loads(l) for l in lines])
+
+        with self._lock:
+            if done == len(lines):
+                os.remove(path)
+            elif done:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    f.writelines(lines[done:])
+                os.rename(tmp_path, path)
+
+            self.spooled -= done
+            self.spool_bytes -= sum(len(l) for l in lines[:done])
+
+        return done == len(lines)
@@ -23,3 +23,14 @@ def load_object(imp_path):
     module = __import__(module_name)
     obj = attrgetter(obj_name)(module)
     return obj
+
+
+def str2bool(v):
+    """
+    Converts a command line flag value to a bool.
+
+    >>> str2bool("true"), str2bool("1"), str2bool("no")
+    (True, True, False)
+
+    """
+    return str(v).lower() in ("true", "yes", "1")
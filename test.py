@@ -1,12 +1,15 @@
 import doctest
 import unittest
 
-from gmaildump import gmailhistory
+from gmaildump import gmailhistory, messagestore, sink, util
 
 
 def suitefn():
     suite = unittest.TestSuite()
     suite.addTests(doctest.DocTestSuite(gmailhistory))
+    suite.addTests(doctest.DocTestSuite(messagestore))
+    suite.addTests(doctest.DocTestSuite(sink))
+    suite.addTests(doctest.DocTestSuite(util))
     return suite
 
 